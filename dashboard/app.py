@@ -6,11 +6,15 @@ Sistema de monitoreo en tiempo real para torres de transmisión
 import streamlit as st
 import pandas as pd
 import numpy as np
-import requests
+import asyncio
+import aiohttp
+import pydeck as pdk
 import plotly.graph_objects as go
 import plotly.express as px
 from plotly.subplots import make_subplots
 from datetime import datetime, timedelta
+from pathlib import Path
+import threading
 import time
 
 # ============================================================================
@@ -28,21 +32,46 @@ st.set_page_config(
 # FUNCIONES DE CARGA DE DATOS
 # ============================================================================
 
+def leer_tabla(ruta_csv):
+    """Lee la versión parquet de un CSV si está al día; si no, el CSV con el motor de pyarrow"""
+    ruta_csv = Path(ruta_csv)
+    ruta_parquet = ruta_csv.with_suffix('.parquet')
+    
+    if ruta_parquet.exists() and (
+        not ruta_csv.exists() or ruta_parquet.stat().st_mtime >= ruta_csv.stat().st_mtime
+    ):
+        return pd.read_parquet(ruta_parquet, engine='pyarrow')
+    
+    return pd.read_csv(ruta_csv, engine='pyarrow')
+
+COLUMNAS_CATEGORICAS_TORRES = [
+    'Amenaza_SGC', 'Clasificacion_Riesgo', 'Pendiente_Clase', 'Tipo_Suelo', 'Cobertura_Vegetal'
+]
+COLUMNAS_FLOAT32_TORRES = ['Latitud', 'Longitud', 'Pendiente_Grados', 'Indice_Riesgo']
+
 @st.cache_data
 def cargar_torres():
     """Carga datos completos de torres"""
     try:
-        df = pd.read_csv("../data/03_external/ubicacion_torres_completo.csv")
-        return df
+        df = leer_tabla("../data/03_external/ubicacion_torres_completo.csv")
     except FileNotFoundError:
         st.error("❌ No se encontró el archivo de torres. Ejecuta primero: python simular_datos.py")
         st.stop()
+    
+    # Columnas de baja cardinalidad como categorías: filtros por código entero
+    for col in COLUMNAS_CATEGORICAS_TORRES:
+        df[col] = df[col].astype('category')
+    
+    for col in COLUMNAS_FLOAT32_TORRES:
+        df[col] = df[col].astype(np.float32)
+    
+    return df
 
 @st.cache_data
 def cargar_umbrales():
     """Carga matriz de umbrales de lluvia"""
     try:
-        df = pd.read_csv("../data/03_external/umbrales_lluvia.csv")
+        df = leer_tabla("../data/03_external/umbrales_lluvia.csv")
         return df
     except FileNotFoundError:
         # Umbrales por defecto
@@ -57,7 +86,7 @@ def cargar_umbrales():
 def cargar_historial_eventos():
     """Carga historial de eventos"""
     try:
-        df = pd.read_csv("../data/03_external/historial_eventos.csv")
+        df = leer_tabla("../data/03_external/historial_eventos.csv")
         df['Fecha'] = pd.to_datetime(df['Fecha'])
         return df
     except FileNotFoundError:
@@ -67,49 +96,440 @@ def cargar_historial_eventos():
 # FUNCIONES DE API Y PROCESAMIENTO
 # ============================================================================
 
-@st.cache_data(ttl=3600)  # Cache por 1 hora
-def obtener_lluvia_torre(lat, lon, dias=3):
-    """Obtiene datos de precipitación de Open-Meteo"""
+TORRES_POR_PETICION = 100  # Coordenadas por petición (límite práctico de longitud de URL)
+DIAS_HISTORICO = 7  # Una sola consulta sirve los acumulados y el detalle de 7 días
+
+RUTA_CACHE_LLUVIA = Path("../data/cache/openmeteo.parquet")
+VIGENCIA_CACHE_LLUVIA = timedelta(hours=1)
+
+async def fetch_lluvia(session, lote, dias=DIAS_HISTORICO):
+    """Obtiene la serie horaria de precipitación de Open-Meteo para un lote de torres en una sola petición"""
     end_date = datetime.now()
     start_date = end_date - timedelta(days=dias)
     
+    lats = ",".join(lote['Latitud'].astype(str))
+    lons = ",".join(lote['Longitud'].astype(str))
+    
     url = (
         f"https://api.open-meteo.com/v1/forecast?"
-        f"latitude={lat}&longitude={lon}"
+        f"latitude={lats}&longitude={lons}"
         f"&hourly=precipitation"
         f"&start_date={start_date.strftime('%Y-%m-%d')}"
         f"&end_date={end_date.strftime('%Y-%m-%d')}"
     )
     
+    # (tiempos, precipitación) por torre; None si no hubo datos
+    series = [None] * len(lote)
+    
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+            response.raise_for_status()
+            data = await response.json()
+        
+        # Con una sola coordenada la API devuelve un objeto en lugar de una lista
+        if isinstance(data, dict):
+            data = [data]
         
-        if 'hourly' in data:
-            df = pd.DataFrame(data['hourly'])
-            df['time'] = pd.to_datetime(df['time'])
-            return df
-        return None
+        for i, loc in enumerate(data):
+            if 'hourly' in loc:
+                series[i] = (
+                    np.asarray(loc['hourly']['time'], dtype='datetime64[m]'),
+                    # None -> NaN para ignorar horas sin dato, igual que pandas.sum()
+                    np.asarray(loc['hourly']['precipitation'], dtype=np.float32)
+                )
     except:
-        return None
+        pass
+    
+    return series
+
+async def fetch_all(torres, on_progreso=None):
+    """
+    Consulta todas las torres agrupadas en lotes, en paralelo con una sola sesión HTTP.
+    on_progreso(fraccion) se llama en saltos de ~5% para no saturar el frontend.
+    """
+    lotes = [
+        torres.iloc[i:i + TORRES_POR_PETICION]
+        for i in range(0, len(torres), TORRES_POR_PETICION)
+    ]
+    resultados = [None] * len(lotes)
+    paso = max(1, len(lotes) // 20)
+    
+    async def fetch_lote(i, session, lote):
+        return i, await fetch_lluvia(session, lote)
+    
+    connector = aiohttp.TCPConnector(limit=20)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tareas = [fetch_lote(i, session, lote) for i, lote in enumerate(lotes)]
+        
+        for completadas, tarea in enumerate(asyncio.as_completed(tareas), start=1):
+            i, series = await tarea
+            resultados[i] = series
+            
+            if on_progreso is not None and (completadas % paso == 0 or completadas == len(lotes)):
+                on_progreso(completadas / len(lotes))
+    
+    return [serie for lote in resultados for serie in lote]
+
+def leer_cache_lluvia():
+    """Lee del disco las series de precipitación aún vigentes, indexadas por (lat, lon)"""
+    try:
+        cache = pd.read_parquet(RUTA_CACHE_LLUVIA)
+    except (FileNotFoundError, OSError):
+        return {}
+    
+    cache = cache[cache['Consultado'] >= datetime.now() - VIGENCIA_CACHE_LLUVIA]
+    return {
+        clave: (
+            grupo['time'].to_numpy(dtype='datetime64[m]'),
+            grupo['precipitation'].to_numpy(dtype=np.float32)
+        )
+        for clave, grupo in cache.groupby(['Latitud', 'Longitud'], sort=False)
+    }
+
+def guardar_cache_lluvia(nuevas, estado, generacion):
+    """
+    Agrega series nuevas al cache en disco y descarta las consultas vencidas.
+    No escribe si un refresco manual cambió la generación desde que se consultaron.
+    """
+    with estado['lock_disco']:
+        if estado['generacion'] != generacion:
+            return
+        
+        try:
+            cache = pd.read_parquet(RUTA_CACHE_LLUVIA)
+            cache = cache[cache['Consultado'] >= datetime.now() - VIGENCIA_CACHE_LLUVIA]
+            claves = pd.MultiIndex.from_frame(nuevas[['Latitud', 'Longitud']])
+            cache = cache[~pd.MultiIndex.from_frame(cache[['Latitud', 'Longitud']]).isin(claves)]
+            nuevas = pd.concat([cache, nuevas], ignore_index=True)
+        except (FileNotFoundError, OSError):
+            pass
+        
+        RUTA_CACHE_LLUVIA.parent.mkdir(parents=True, exist_ok=True)
+        ruta_tmp = RUTA_CACHE_LLUVIA.with_suffix('.tmp')
+        nuevas.to_parquet(ruta_tmp, index=False)
+        ruta_tmp.replace(RUTA_CACHE_LLUVIA)
+
+@st.cache_resource
+def estado_cache_lluvia():
+    """
+    Locks y generación del cache de lluvia, compartidos por todas las sesiones
+    (las variables del script se recrean en cada rerun, un Lock de módulo no serviría).
+    """
+    return {
+        'lock_series': threading.Lock(),  # Consulta y escritura de series en memoria
+        'lock_disco': threading.Lock(),  # Escritura y borrado del parquet
+        'generacion': 0  # Aumenta con cada refresco manual
+    }
+
+@st.cache_resource(ttl=3600)  # Cache por 1 hora
+def series_lluvia_en_memoria():
+    """
+    Series de precipitación del proceso indexadas por (lat, lon), iniciadas desde el cache en disco.
+    Las consultas fallidas se guardan como None para no reintentarlas en cada rerun.
+    """
+    return leer_cache_lluvia()
+
+def claves_lluvia(torres):
+    """Claves (lat, lon) de cada torre; float64 antes de redondear para coincidir con el cache en disco"""
+    return list(zip(
+        torres['Latitud'].astype(float).round(3),
+        torres['Longitud'].astype(float).round(3)
+    ))
+
+def obtener_lluvia_torres(torres, on_progreso=None):
+    """
+    Obtiene acumulados de 72h y 24h para todas las torres.
+    Retorna también la serie horaria de 7 días de cada torre, indexada por ID_Torre.
+    Sin cache de Streamlit a propósito: on_progreso actualiza elementos de la página,
+    que no pueden llamarse desde una función cacheada. Solo consulta la API para
+    las torres sin serie en memoria.
+    """
+    claves = claves_lluvia(torres)
+    series_por_clave = series_lluvia_en_memoria()
+    estado = estado_cache_lluvia()
+    
+    # Una sola sesión consulta a la vez; las demás encuentran las series ya cargadas
+    with estado['lock_series']:
+        generacion = estado['generacion']
+        faltantes = [clave not in series_por_clave for clave in claves]
+        if any(faltantes):
+            nuevas = consultar_series_faltantes(torres, claves, faltantes, series_por_clave, on_progreso)
+            
+            # La escritura a disco no bloquea el render
+            if nuevas is not None:
+                threading.Thread(
+                    target=guardar_cache_lluvia,
+                    args=(nuevas, estado, generacion)
+                ).start()
+    
+    return resumir_lluvia_torres(torres, series_por_clave)
+
+def consultar_series_faltantes(torres, claves, faltantes, series_por_clave, on_progreso=None):
+    """
+    Consulta la API para las torres faltantes y guarda sus series en memoria.
+    Retorna las series obtenidas en formato largo para el cache en disco (None si no hay ninguna).
+    """
+    torres_faltantes = torres.loc[faltantes, ['ID_Torre', 'Latitud', 'Longitud']]
+    series = asyncio.run(fetch_all(torres_faltantes, on_progreso))
+    
+    consultado = datetime.now()
+    nuevas = []
+    claves_faltantes = [clave for clave, falta in zip(claves, faltantes) if falta]
+    for clave, serie in zip(claves_faltantes, series):
+        series_por_clave[clave] = serie
+        if serie is not None:
+            tiempos, precip = serie
+            nuevas.append(pd.DataFrame({
+                'Latitud': clave[0],
+                'Longitud': clave[1],
+                'time': tiempos,
+                'precipitation': precip,
+                'Consultado': consultado
+            }))
+    
+    return pd.concat(nuevas, ignore_index=True) if nuevas else None
+
+def resumir_lluvia_torres(torres, series_por_clave):
+    """
+    Acumulados por torre a partir de las series en memoria.
+    Sin cache de Streamlit: las series cambian con su propio TTL y con el refresco manual,
+    y el cálculo son dos sumas por torre.
+    """
+    datos_lluvia = []
+    series_por_torre = {}
+    for id_torre, clave in zip(torres['ID_Torre'], claves_lluvia(torres)):
+        serie = series_por_clave.get(clave)
+        if serie is not None:
+            precip = serie[1]
+            series_por_torre[id_torre] = serie
+            lluvia_72h = float(np.nansum(precip[-72:]))
+            lluvia_24h = float(np.nansum(precip[-24:]))
+        else:
+            lluvia_72h = 0
+            lluvia_24h = 0
+        
+        datos_lluvia.append({
+            'ID_Torre': id_torre,
+            'Lluvia_72h': lluvia_72h,
+            'Lluvia_24h': lluvia_24h
+        })
+    
+    return pd.DataFrame(datos_lluvia), series_por_torre
+
+CATEGORIAS_AMENAZA = pd.Index(['Muy Baja', 'Baja', 'Media', 'Alta', 'Muy Alta'])
+
+# Etiquetas indexadas por prioridad (0 = amenaza sin umbral definido)
+NIVELES_ALERTA = np.array(['VERDE', 'VERDE', 'AMARILLA', 'ROJA'])
+EMOJIS_ALERTA = np.array(['🟢', '🟢', '🟡', '🔴'])
+
+def construir_umbrales_por_codigo(umbrales_df):
+    """
+    Umbrales rojo y amarillo como arrays indexados por código de amenaza.
+    La última posición es NaN, de modo que el código -1 (amenaza desconocida) no tiene umbral.
+    """
+    umbrales = umbrales_df.set_index('Amenaza_Nivel').reindex(CATEGORIAS_AMENAZA)
+    umbral_rojo = np.append(umbrales['Umbral_Rojo_mm'].to_numpy(np.float32), np.float32(np.nan))
+    umbral_amarillo = np.append(umbrales['Umbral_Amarillo_mm'].to_numpy(np.float32), np.float32(np.nan))
+    return umbral_rojo, umbral_amarillo
+
+def calcular_nivel_alerta(torres_df, umbrales_por_codigo):
+    """Calcula nivel de alerta de todas las torres usando matriz de umbrales"""
+    umbral_rojo_arr, umbral_amarillo_arr = umbrales_por_codigo
+    codigos = CATEGORIAS_AMENAZA.get_indexer(torres_df['Amenaza_SGC'])
+    
+    lluvia = torres_df['Lluvia_72h'].to_numpy()
+    umbral_rojo = umbral_rojo_arr[codigos]
+    umbral_amarillo = umbral_amarillo_arr[codigos]
+    
+    prioridad = np.where(lluvia >= umbral_rojo, 3, np.where(lluvia >= umbral_amarillo, 2, 1))
+    prioridad[np.isnan(umbral_rojo)] = 0
+    
+    return NIVELES_ALERTA[prioridad], EMOJIS_ALERTA[prioridad], prioridad
 
-def calcular_nivel_alerta(amenaza, lluvia_72h, umbrales_df):
-    """Calcula nivel de alerta usando matriz de umbrales"""
-    umbral = umbrales_df[umbrales_df['Amenaza_Nivel'] == amenaza]
+@st.cache_data
+def construir_torres_alertas(torres_df, df_lluvia, umbrales_por_codigo):
+    """Combina torres con precipitación y calcula alertas, ordenadas por prioridad e indexadas por ID_Torre"""
+    torres_df = torres_df.merge(df_lluvia, on='ID_Torre')
+    
+    nivel, emoji, prioridad = calcular_nivel_alerta(torres_df, umbrales_por_codigo)
+    torres_df['Nivel_Alerta'] = nivel
+    torres_df['Emoji_Alerta'] = emoji
+    torres_df['Prioridad'] = prioridad
     
-    if umbral.empty:
-        return 'VERDE', '🟢', 0
+    # Índice por ID (conservando la columna) para buscar una torre con .loc sin recorrer el frame
+    return torres_df.sort_values('Prioridad', ascending=False).set_index('ID_Torre', drop=False).rename_axis(None)
+
+@st.cache_data
+def convertir_csv(df):
+    """Serializa un DataFrame a CSV para descarga (solo se recalcula si cambia el contenido)"""
+    return df.to_csv(index=False).encode('utf-8')
+
+@st.cache_data(ttl=3600)  # Cache por 1 hora
+def construir_figura_detalle(id_torre, tiempos_bytes, precip_bytes, umbral_rojo, umbral_amarillo):
+    """
+    Construye la figura de evolución de riesgo de una torre y las horas en cada nivel de alerta.
+    Las series llegan como bytes (hashables); umbrales NaN si la amenaza no tiene umbral.
+    """
+    df_lluvia_torre = pd.DataFrame({
+        'time': pd.to_datetime(np.frombuffer(tiempos_bytes, dtype='datetime64[m]')),
+        'precipitation': np.frombuffer(precip_bytes, dtype=np.float32)
+    })
+    tiene_umbral = not np.isnan(umbral_rojo)
     
-    umbral_rojo = umbral['Umbral_Rojo_mm'].values[0]
-    umbral_amarillo = umbral['Umbral_Amarillo_mm'].values[0]
+    # Calcular acumulado rodante de 72h (suma acumulada menos la de 72h atrás)
+    precip = np.nan_to_num(df_lluvia_torre['precipitation'].to_numpy(dtype=np.float32))
+    acumulada = np.concatenate(([0.0], np.cumsum(precip)))
+    idx = np.arange(len(precip))
+    df_lluvia_torre['precip_acum_72h'] = acumulada[idx + 1] - acumulada[np.maximum(0, idx - 71)]
     
-    if lluvia_72h >= umbral_rojo:
-        return 'ROJA', '🔴', 3
-    elif lluvia_72h >= umbral_amarillo:
-        return 'AMARILLA', '🟡', 2
+    # Calcular nivel de alerta para cada punto en el tiempo
+    if tiene_umbral:
+        acumulado = df_lluvia_torre['precip_acum_72h'].to_numpy()
+        df_lluvia_torre['nivel_alerta_temporal'] = np.select(
+            [acumulado >= umbral_rojo, acumulado >= umbral_amarillo],
+            ['ROJA', 'AMARILLA'],
+            default='VERDE'
+        )
     else:
-        return 'VERDE', '🟢', 1
+        df_lluvia_torre['nivel_alerta_temporal'] = 'VERDE'
+    
+    # Crear dos subgráficos
+    fig_lluvia = make_subplots(
+        rows=2, cols=1,
+        subplot_titles=(
+            'Evolución de Precipitación Acumulada (72h)',
+            'Evolución del Nivel de Alerta en el Tiempo'
+        ),
+        vertical_spacing=0.12,
+        row_heights=[0.6, 0.4]
+    )
+    
+    # GRÁFICO 1: Línea de precipitación acumulada
+    fig_lluvia.add_trace(
+        go.Scatter(
+            x=df_lluvia_torre['time'],
+            y=df_lluvia_torre['precip_acum_72h'],
+            mode='lines',
+            name='Lluvia Acumulada 72h',
+            line=dict(color='steelblue', width=2),
+            fill='tozeroy',
+            fillcolor='rgba(70, 130, 180, 0.2)'
+        ),
+        row=1, col=1
+    )
+    
+    # Agregar líneas de umbrales
+    if tiene_umbral:
+        # Líneas horizontales de umbrales
+        fig_lluvia.add_hline(
+            y=umbral_amarillo,
+            line_dash="dash",
+            line_color="orange",
+            line_width=2,
+            annotation_text=f"Umbral Amarillo ({umbral_amarillo:g}mm)",
+            annotation_position="right",
+            row=1, col=1
+        )
+        fig_lluvia.add_hline(
+            y=umbral_rojo,
+            line_dash="dash",
+            line_color="red",
+            line_width=2,
+            annotation_text=f"Umbral Rojo ({umbral_rojo:g}mm)",
+            annotation_position="right",
+            row=1, col=1
+        )
+        
+        # Resaltar momentos de alerta
+        alertas_rojas = df_lluvia_torre[df_lluvia_torre['nivel_alerta_temporal'] == 'ROJA']
+        alertas_amarillas = df_lluvia_torre[df_lluvia_torre['nivel_alerta_temporal'] == 'AMARILLA']
+        
+        if not alertas_rojas.empty:
+            fig_lluvia.add_trace(
+                go.Scatter(
+                    x=alertas_rojas['time'],
+                    y=alertas_rojas['precip_acum_72h'],
+                    mode='markers',
+                    name='Alerta ROJA',
+                    marker=dict(color='red', size=10, symbol='x', line=dict(width=2, color='darkred'))
+                ),
+                row=1, col=1
+            )
+        
+        if not alertas_amarillas.empty:
+            fig_lluvia.add_trace(
+                go.Scatter(
+                    x=alertas_amarillas['time'],
+                    y=alertas_amarillas['precip_acum_72h'],
+                    mode='markers',
+                    name='Alerta AMARILLA',
+                    marker=dict(color='orange', size=8, symbol='circle')
+                ),
+                row=1, col=1
+            )
+    
+    # GRÁFICO 2: Evolución del nivel de alerta (área coloreada)
+    # Mapear alertas a valores numéricos para el gráfico
+    alerta_map = {'VERDE': 0, 'AMARILLA': 1, 'ROJA': 2}
+    df_lluvia_torre['alerta_num'] = df_lluvia_torre['nivel_alerta_temporal'].map(alerta_map)
+    
+    # Crear áreas coloreadas por nivel de alerta
+    color_alerta = {'VERDE': 'green', 'AMARILLA': 'orange', 'ROJA': 'red'}
+    
+    for nivel in ['VERDE', 'AMARILLA', 'ROJA']:
+        df_nivel = df_lluvia_torre[df_lluvia_torre['nivel_alerta_temporal'] == nivel]
+        if not df_nivel.empty:
+            fig_lluvia.add_trace(
+                go.Scatter(
+                    x=df_nivel['time'],
+                    y=[alerta_map[nivel]] * len(df_nivel),
+                    mode='markers',
+                    name=nivel,
+                    marker=dict(
+                        color=color_alerta[nivel],
+                        size=8,
+                        symbol='square'
+                    ),
+                    showlegend=False
+                ),
+                row=2, col=1
+            )
+    
+    # Línea conectando los puntos
+    fig_lluvia.add_trace(
+        go.Scatter(
+            x=df_lluvia_torre['time'],
+            y=df_lluvia_torre['alerta_num'],
+            mode='lines',
+            line=dict(color='gray', width=1, dash='dot'),
+            showlegend=False,
+            hoverinfo='skip'
+        ),
+        row=2, col=1
+    )
+    
+    # Configurar ejes
+    fig_lluvia.update_xaxes(title_text="Fecha y Hora", row=2, col=1)
+    fig_lluvia.update_yaxes(title_text="Precipitación (mm)", row=1, col=1)
+    fig_lluvia.update_yaxes(
+        title_text="Nivel de Alerta",
+        tickmode='array',
+        tickvals=[0, 1, 2],
+        ticktext=['🟢 VERDE', '🟡 AMARILLA', '🔴 ROJA'],
+        row=2, col=1
+    )
+    
+    fig_lluvia.update_layout(
+        title_text=f"Evolución de Riesgo - {id_torre}",
+        height=700,
+        hovermode='x unified',
+        showlegend=True
+    )
+    
+    horas_por_nivel = df_lluvia_torre['nivel_alerta_temporal'].value_counts()
+    conteos = {nivel: int(horas_por_nivel.get(nivel, 0)) for nivel in ['ROJA', 'AMARILLA', 'VERDE']}
+    
+    return fig_lluvia, conteos, len(df_lluvia_torre)
 
 # ============================================================================
 # INTERFAZ PRINCIPAL
@@ -133,6 +553,11 @@ torres_df = cargar_torres()
 umbrales_df = cargar_umbrales()
 eventos_df = cargar_historial_eventos()
 
+# Umbrales como arrays por código de amenaza: se construyen una vez por sesión
+if 'umbrales_por_codigo' not in st.session_state:
+    st.session_state['umbrales_por_codigo'] = construir_umbrales_por_codigo(umbrales_df)
+umbrales_por_codigo = st.session_state['umbrales_por_codigo']
+
 # Selector de torre
 torre_seleccionada = st.sidebar.selectbox(
     "📍 Seleccionar Torre:",
@@ -156,10 +581,27 @@ filtro_riesgo = st.sidebar.multiselect(
     default=['Alto']
 )
 
+# Filtros estáticos: no dependen de la lluvia, se resuelven una vez sobre los datos base
+mascara_filtros = pd.Series(True, index=torres_df.index)
+if filtro_amenaza:
+    mascara_filtros &= torres_df['Amenaza_SGC'].isin(filtro_amenaza)
+if filtro_riesgo:
+    mascara_filtros &= torres_df['Clasificacion_Riesgo'].isin(filtro_riesgo)
+ids_filtrados = torres_df.loc[mascara_filtros, 'ID_Torre']
+
 # Botón de actualización
 st.sidebar.markdown("---")
 if st.sidebar.button("🔄 Actualizar Datos de Lluvia", type="primary"):
     st.cache_data.clear()
+    # Bajo el lock de disco: un guardado en curso no puede recrear el parquet,
+    # y los pendientes de la generación anterior se descartan
+    estado = estado_cache_lluvia()
+    with estado['lock_disco']:
+        estado['generacion'] += 1
+        RUTA_CACHE_LLUVIA.unlink(missing_ok=True)
+    # Después del borrado, para que la memoria no se recargue desde el parquet viejo
+    series_lluvia_en_memoria.clear()
+    st.session_state.pop('umbrales_por_codigo', None)
     st.rerun()
 
 st.sidebar.markdown("---")
@@ -170,50 +612,18 @@ st.sidebar.caption(f"🕐 Última actualización: {datetime.now().strftime('%H:%
 # ============================================================================
 
 with st.spinner('🌧️ Obteniendo datos de precipitación...'):
-    datos_lluvia = []
-    
     # Barra de progreso
     progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    for idx, (i, torre) in enumerate(torres_df.iterrows()):
-        progress = (idx + 1) / len(torres_df)
-        progress_bar.progress(progress)
-        status_text.text(f"Consultando {torre['ID_Torre']}... ({idx+1}/{len(torres_df)})")
-        
-        df_lluvia = obtener_lluvia_torre(torre['Latitud'], torre['Longitud'])
-        
-        if df_lluvia is not None:
-            lluvia_72h = df_lluvia['precipitation'].sum()
-            lluvia_24h = df_lluvia.tail(24)['precipitation'].sum()
-        else:
-            lluvia_72h = 0
-            lluvia_24h = 0
-        
-        datos_lluvia.append({
-            'ID_Torre': torre['ID_Torre'],
-            'Lluvia_72h': lluvia_72h,
-            'Lluvia_24h': lluvia_24h
-        })
-    
+    df_lluvia, series_lluvia = obtener_lluvia_torres(torres_df, on_progreso=progress_bar.progress)
     progress_bar.empty()
-    status_text.empty()
-
-# Combinar con datos de torres
-df_lluvia = pd.DataFrame(datos_lluvia)
-torres_df = torres_df.merge(df_lluvia, on='ID_Torre')
-
-# Calcular alertas
-torres_df[['Nivel_Alerta', 'Emoji_Alerta', 'Prioridad']] = torres_df.apply(
-    lambda row: pd.Series(calcular_nivel_alerta(
-        row['Amenaza_SGC'], 
-        row['Lluvia_72h'], 
-        umbrales_df
-    )), axis=1
-)
 
-# Ordenar por prioridad
-torres_df = torres_df.sort_values('Prioridad', ascending=False)
+st.sidebar.caption(f"🌧️ Precipitación disponible: {len(series_lluvia)}/{len(torres_df)} torres")
+
+# Combinar con datos de torres y calcular alertas
+torres_df = construir_torres_alertas(torres_df, df_lluvia, umbrales_por_codigo)
+
+# Mapa y tabla: subconjunto de las torres ya anotadas que pasan los filtros estáticos
+torres_filtradas = torres_df[torres_df['ID_Torre'].isin(ids_filtrados)]
 
 # ============================================================================
 # SECCIÓN 1: RESUMEN EJECUTIVO
@@ -242,53 +652,95 @@ col5.metric("⚠️ Alto Riesgo Base", n_alto_riesgo)
 st.markdown("---")
 st.header("🗺️ Mapa de Torres con Alertas")
 
-# Crear mapa
-fig_mapa = go.Figure()
-
 color_map = {'VERDE': 'green', 'AMARILLA': 'orange', 'ROJA': 'red'}
+color_rgb_map = {'VERDE': [0, 128, 0], 'AMARILLA': [255, 165, 0], 'ROJA': [255, 0, 0]}
 size_map = {'VERDE': 12, 'AMARILLA': 16, 'ROJA': 20}
+UMBRAL_AGRUPACION_MAPA = 1000  # Torres a partir de las cuales el mapa se agrupa por defecto
 
-for nivel in ['VERDE', 'AMARILLA', 'ROJA']:
-    torres_nivel = torres_df[torres_df['Nivel_Alerta'] == nivel]
-    
-    if not torres_nivel.empty:
-        fig_mapa.add_trace(go.Scattermapbox(
-            lat=torres_nivel['Latitud'],
-            lon=torres_nivel['Longitud'],
-            mode='markers',
-            marker=dict(
-                size=torres_nivel['Nivel_Alerta'].map(size_map),
-                color=color_map[nivel]
-            ),
-            text=torres_nivel.apply(
-                lambda x: (
-                    f"<b>{x['ID_Torre']}: {x['Nombre']}</b><br>"
-                    f"Amenaza: {x['Amenaza_SGC']}<br>"
-                    f"Pendiente: {x['Pendiente_Grados']:.1f}°<br>"
-                    f"Lluvia 72h: {x['Lluvia_72h']:.1f}mm<br>"
-                    f"Riesgo: {x['Clasificacion_Riesgo']}<br>"
-                    f"<b>Alerta: {x['Nivel_Alerta']}</b>"
-                ), axis=1
-            ),
-            hoverinfo='text',
-            name=f'{nivel}'
-        ))
-
-fig_mapa.update_layout(
-    mapbox=dict(
-        style='open-street-map',
-        center=dict(
-            lat=torres_df['Latitud'].mean(),
-            lon=torres_df['Longitud'].mean()
-        ),
-        zoom=8
-    ),
-    height=500,
-    margin=dict(l=0, r=0, t=0, b=0),
-    showlegend=True
+# Campos del tooltip: el formato lo hace el navegador a partir de las columnas
+COLUMNAS_HOVER = [
+    'ID_Torre', 'Nombre', 'Amenaza_SGC', 'Pendiente_Grados',
+    'Lluvia_72h', 'Clasificacion_Riesgo', 'Nivel_Alerta'
+]
+HOVERTEMPLATE_TORRE = (
+    "<b>%{customdata[0]}: %{customdata[1]}</b><br>"
+    "Amenaza: %{customdata[2]}<br>"
+    "Pendiente: %{customdata[3]:.1f}°<br>"
+    "Lluvia 72h: %{customdata[4]:.1f}mm<br>"
+    "Riesgo: %{customdata[5]}<br>"
+    "<b>Alerta: %{customdata[6]}</b><extra></extra>"
 )
 
-st.plotly_chart(fig_mapa, use_container_width=True)
+if torres_filtradas.empty:
+    st.info("ℹ️ Ninguna torre cumple los filtros seleccionados")
+else:
+    # assign devuelve un frame nuevo: no se escribe sobre el subconjunto filtrado
+    torres_mapa = torres_filtradas.assign(
+        _color_rgb=torres_filtradas['Nivel_Alerta'].map(color_rgb_map),
+        _size=torres_filtradas['Nivel_Alerta'].map(size_map)
+    )
+
+    # Con muchas torres los puntos se solapan: se agregan en hexágonos por defecto
+    agrupar_torres = st.toggle(
+        "Agrupar torres en hexágonos",
+        value=len(torres_mapa) > UMBRAL_AGRUPACION_MAPA,
+        help="Cada hexágono toma el color de la alerta más alta de sus torres"
+    )
+
+    if agrupar_torres:
+        capa_torres = pdk.Layer(
+            "HexagonLayer",
+            torres_mapa[['Latitud', 'Longitud', 'Prioridad']],
+            get_position=['Longitud', 'Latitud'],
+            radius=2000,
+            extruded=False,
+            get_color_weight='Prioridad',
+            color_aggregation='"MAX"',  # Literal entre comillas: pydeck trata las cadenas simples como expresiones
+            color_domain=[1, 3],
+            color_range=list(color_rgb_map.values()),
+            pickable=True
+        )
+        tooltip = {'html': 'Torres: {elevationValue}'}
+    else:
+        # Capa WebGL: todas las torres en un solo draw call instanciado en GPU
+        capa_torres = pdk.Layer(
+            "ScatterplotLayer",
+            # pydeck no formatea números: se redondean en bloque antes de serializar
+            torres_mapa[['Latitud', 'Longitud', '_color_rgb', '_size'] + COLUMNAS_HOVER].round({
+                'Pendiente_Grados': 1, 'Lluvia_72h': 1
+            }),
+            get_position=['Longitud', 'Latitud'],
+            get_fill_color='_color_rgb',
+            get_radius='_size',
+            radius_units='pixels',
+            radius_scale=0.5,  # _size es diámetro en píxeles
+            pickable=True
+        )
+        tooltip = {
+            'html': (
+                "<b>{ID_Torre}: {Nombre}</b><br>"
+                "Amenaza: {Amenaza_SGC}<br>"
+                "Pendiente: {Pendiente_Grados}°<br>"
+                "Lluvia 72h: {Lluvia_72h}mm<br>"
+                "Riesgo: {Clasificacion_Riesgo}<br>"
+                "<b>Alerta: {Nivel_Alerta}</b>"
+            )
+        }
+
+    mapa = pdk.Deck(
+        layers=[capa_torres],
+        initial_view_state=pdk.ViewState(
+            latitude=torres_mapa['Latitud'].mean(),
+            longitude=torres_mapa['Longitud'].mean(),
+            zoom=8
+        ),
+        map_provider='carto',
+        map_style='light',
+        tooltip=tooltip
+    )
+
+    st.pydeck_chart(mapa, use_container_width=True)
+    st.caption("🟢 VERDE · 🟡 AMARILLA · 🔴 ROJA")
 
 # ============================================================================
 # SECCIÓN 3: MATRIZ DE RIESGO
@@ -309,21 +761,14 @@ with col1:
         color_discrete_map=color_map,
         size='Pendiente_Grados',
         size_max=20,
-        hover_data={
-            'ID_Torre': True,
-            'Nombre': True,
-            'Amenaza_SGC': True,
-            'Pendiente_Grados': ':.1f',
-            'Lluvia_72h': ':.1f',
-            'Clasificacion_Riesgo': True,
-            'Amenaza_Valor': False
-        },
+        custom_data=COLUMNAS_HOVER,
         labels={
             'Lluvia_72h': 'Precipitación Acumulada 72h (mm)',
             'Amenaza_Valor': 'Nivel de Amenaza'
         },
         title='Matriz de Riesgo Combinado'
     )
+    fig_matriz.update_traces(hovertemplate=HOVERTEMPLATE_TORRE)
     
     # Agregar zonas de riesgo
     max_lluvia = torres_df['Lluvia_72h'].max() * 1.1
@@ -359,7 +804,7 @@ with col2:
 st.markdown("---")
 st.header(f"🔍 Análisis Detallado: {torre_seleccionada}")
 
-torre_info = torres_df[torres_df['ID_Torre'] == torre_seleccionada].iloc[0]
+torre_info = torres_df.loc[torre_seleccionada]
 
 # Métricas de la torre
 col1, col2, col3, col4, col5 = st.columns(5)
@@ -395,120 +840,28 @@ with st.expander("ℹ️ Información Adicional", expanded=True):
         st.write(f"- Últimas 72h: {torre_info['Lluvia_72h']:.1f}mm")
         
         # Obtener umbrales para esta torre
-        umbral_torre = umbrales_df[umbrales_df['Amenaza_Nivel'] == torre_info['Amenaza_SGC']]
-        if not umbral_torre.empty:
-            st.write(f"- Umbral amarillo: {umbral_torre['Umbral_Amarillo_mm'].values[0]}mm")
-            st.write(f"- Umbral rojo: {umbral_torre['Umbral_Rojo_mm'].values[0]}mm")
+        codigo_amenaza = CATEGORIAS_AMENAZA.get_indexer([torre_info['Amenaza_SGC']])[0]
+        umbral_rojo = umbrales_por_codigo[0][codigo_amenaza]
+        umbral_amarillo = umbrales_por_codigo[1][codigo_amenaza]
+        tiene_umbral = not np.isnan(umbral_rojo)
+        if tiene_umbral:
+            st.write(f"- Umbral amarillo: {umbral_amarillo:g}mm")
+            st.write(f"- Umbral rojo: {umbral_rojo:g}mm")
 
 # Gráfico de precipitación para la torre
-df_lluvia_torre = obtener_lluvia_torre(torre_info['Latitud'], torre_info['Longitud'], dias=7)
-
-if df_lluvia_torre is not None:
-    # Calcular acumulado rodante de 72h
-    df_lluvia_torre['precip_acum_72h'] = df_lluvia_torre['precipitation'].rolling(
-        window=72, min_periods=1
-    ).sum()
-    
-    # Calcular nivel de alerta para cada punto en el tiempo
-    def calcular_alerta_temporal(lluvia, amenaza):
-        umbral = umbrales_df[umbrales_df['Amenaza_Nivel'] == amenaza]
-        if umbral.empty:
-            return 'VERDE'
-        
-        umbral_rojo = umbral['Umbral_Rojo_mm'].values[0]
-        umbral_amarillo = umbral['Umbral_Amarillo_mm'].values[0]
-        
-        if lluvia >= umbral_rojo:
-            return 'ROJA'
-        elif lluvia >= umbral_amarillo:
-            return 'AMARILLA'
-        else:
-            return 'VERDE'
-    
-    df_lluvia_torre['nivel_alerta_temporal'] = df_lluvia_torre['precip_acum_72h'].apply(
-        lambda x: calcular_alerta_temporal(x, torre_info['Amenaza_SGC'])
-    )
-    
-    # Crear dos subgráficos
-    from plotly.subplots import make_subplots
-    
-    fig_lluvia = make_subplots(
-        rows=2, cols=1,
-        subplot_titles=(
-            'Evolución de Precipitación Acumulada (72h)',
-            'Evolución del Nivel de Alerta en el Tiempo'
-        ),
-        vertical_spacing=0.12,
-        row_heights=[0.6, 0.4]
-    )
-    
-    # GRÁFICO 1: Línea de precipitación acumulada
-    fig_lluvia.add_trace(
-        go.Scatter(
-            x=df_lluvia_torre['time'],
-            y=df_lluvia_torre['precip_acum_72h'],
-            mode='lines',
-            name='Lluvia Acumulada 72h',
-            line=dict(color='steelblue', width=2),
-            fill='tozeroy',
-            fillcolor='rgba(70, 130, 180, 0.2)'
-        ),
-        row=1, col=1
+# Reutiliza la serie de 7 días ya consultada para el resumen
+serie_torre = series_lluvia.get(torre_seleccionada)
+
+if serie_torre is not None:
+    # La figura se reconstruye solo si cambia la torre o su serie de lluvia
+    fig_lluvia, horas_por_nivel, total_horas = construir_figura_detalle(
+        torre_seleccionada,
+        serie_torre[0].tobytes(),
+        serie_torre[1].tobytes(),
+        float(umbral_rojo),
+        float(umbral_amarillo)
     )
     
-    # Agregar líneas de umbrales
-    if not umbral_torre.empty:
-        umbral_amarillo = umbral_torre['Umbral_Amarillo_mm'].values[0]
-        umbral_rojo = umbral_torre['Umbral_Rojo_mm'].values[0]
-        
-        # Líneas horizontales de umbrales
-        fig_lluvia.add_hline(
-            y=umbral_amarillo,
-            line_dash="dash",
-            line_color="orange",
-            line_width=2,
-            annotation_text=f"Umbral Amarillo ({umbral_amarillo}mm)",
-            annotation_position="right",
-            row=1, col=1
-        )
-        fig_lluvia.add_hline(
-            y=umbral_rojo,
-            line_dash="dash",
-            line_color="red",
-            line_width=2,
-            annotation_text=f"Umbral Rojo ({umbral_rojo}mm)",
-            annotation_position="right",
-            row=1, col=1
-        )
-        
-        # Resaltar momentos de alerta
-        alertas_rojas = df_lluvia_torre[df_lluvia_torre['nivel_alerta_temporal'] == 'ROJA']
-        alertas_amarillas = df_lluvia_torre[df_lluvia_torre['nivel_alerta_temporal'] == 'AMARILLA']
-        
-        if not alertas_rojas.empty:
-            fig_lluvia.add_trace(
-                go.Scatter(
-                    x=alertas_rojas['time'],
-                    y=alertas_rojas['precip_acum_72h'],
-                    mode='markers',
-                    name='Alerta ROJA',
-                    marker=dict(color='red', size=10, symbol='x', line=dict(width=2, color='darkred'))
-                ),
-                row=1, col=1
-            )
-        
-        if not alertas_amarillas.empty:
-            fig_lluvia.add_trace(
-                go.Scatter(
-                    x=alertas_amarillas['time'],
-                    y=alertas_amarillas['precip_acum_72h'],
-                    mode='markers',
-                    name='Alerta AMARILLA',
-                    marker=dict(color='orange', size=8, symbol='circle')
-                ),
-                row=1, col=1
-            )
-    
     # Línea vertical en el presente - enfoque simple
     now = datetime.now()
     # Agregar como forma en lugar de vline para evitar problemas de conversión
@@ -531,46 +884,6 @@ if df_lluvia_torre is not None:
         row=1, col=1
     )
     
-    # GRÁFICO 2: Evolución del nivel de alerta (área coloreada)
-    # Mapear alertas a valores numéricos para el gráfico
-    alerta_map = {'VERDE': 0, 'AMARILLA': 1, 'ROJA': 2}
-    df_lluvia_torre['alerta_num'] = df_lluvia_torre['nivel_alerta_temporal'].map(alerta_map)
-    
-    # Crear áreas coloreadas por nivel de alerta
-    color_alerta = {'VERDE': 'green', 'AMARILLA': 'orange', 'ROJA': 'red'}
-    
-    for nivel in ['VERDE', 'AMARILLA', 'ROJA']:
-        df_nivel = df_lluvia_torre[df_lluvia_torre['nivel_alerta_temporal'] == nivel]
-        if not df_nivel.empty:
-            fig_lluvia.add_trace(
-                go.Scatter(
-                    x=df_nivel['time'],
-                    y=[alerta_map[nivel]] * len(df_nivel),
-                    mode='markers',
-                    name=nivel,
-                    marker=dict(
-                        color=color_alerta[nivel],
-                        size=8,
-                        symbol='square'
-                    ),
-                    showlegend=False
-                ),
-                row=2, col=1
-            )
-    
-    # Línea conectando los puntos
-    fig_lluvia.add_trace(
-        go.Scatter(
-            x=df_lluvia_torre['time'],
-            y=df_lluvia_torre['alerta_num'],
-            mode='lines',
-            line=dict(color='gray', width=1, dash='dot'),
-            showlegend=False,
-            hoverinfo='skip'
-        ),
-        row=2, col=1
-    )
-    
     # Línea vertical en el presente (segunda gráfica)
     fig_lluvia.add_shape(
         type="line",
@@ -581,33 +894,14 @@ if df_lluvia_torre is not None:
         row=2, col=1
     )
     
-    # Configurar ejes
-    fig_lluvia.update_xaxes(title_text="Fecha y Hora", row=2, col=1)
-    fig_lluvia.update_yaxes(title_text="Precipitación (mm)", row=1, col=1)
-    fig_lluvia.update_yaxes(
-        title_text="Nivel de Alerta",
-        tickmode='array',
-        tickvals=[0, 1, 2],
-        ticktext=['🟢 VERDE', '🟡 AMARILLA', '🔴 ROJA'],
-        row=2, col=1
-    )
-    
-    fig_lluvia.update_layout(
-        title_text=f"Evolución de Riesgo - {torre_seleccionada}",
-        height=700,
-        hovermode='x unified',
-        showlegend=True
-    )
-    
     st.plotly_chart(fig_lluvia, use_container_width=True)
     
     # Estadísticas del período
     col1, col2, col3 = st.columns(3)
     
-    tiempo_roja = (df_lluvia_torre['nivel_alerta_temporal'] == 'ROJA').sum()
-    tiempo_amarilla = (df_lluvia_torre['nivel_alerta_temporal'] == 'AMARILLA').sum()
-    tiempo_verde = (df_lluvia_torre['nivel_alerta_temporal'] == 'VERDE').sum()
-    total_horas = len(df_lluvia_torre)
+    tiempo_roja = horas_por_nivel['ROJA']
+    tiempo_amarilla = horas_por_nivel['AMARILLA']
+    tiempo_verde = horas_por_nivel['VERDE']
     
     col1.metric(
         "🔴 Tiempo en Alerta Roja",
@@ -632,53 +926,51 @@ if df_lluvia_torre is not None:
 st.markdown("---")
 st.header("📋 Tabla de Torres Monitoreadas")
 
-# Aplicar filtros
-torres_filtradas = torres_df.copy()
-
-if filtro_amenaza:
-    torres_filtradas = torres_filtradas[torres_filtradas['Amenaza_SGC'].isin(filtro_amenaza)]
-
-if filtro_riesgo:
-    torres_filtradas = torres_filtradas[torres_filtradas['Clasificacion_Riesgo'].isin(filtro_riesgo)]
-
 # Configurar colores
-def colorear_alerta(val):
-    color_dict = {
-        'ROJA': 'background-color: #ffcccc',
-        'AMARILLA': 'background-color: #fff4cc',
-        'VERDE': 'background-color: #ccffcc'
-    }
-    return color_dict.get(val, '')
+css_alerta = {
+    'ROJA': 'background-color: #ffcccc',
+    'AMARILLA': 'background-color: #fff4cc',
+    'VERDE': 'background-color: #ccffcc'
+}
+
+def colorear_alerta(columna):
+    """Estilo de toda la columna en una sola llamada (en lugar de una por celda)"""
+    return columna.map(css_alerta).fillna('')
+
+if torres_filtradas.empty:
+    st.info("ℹ️ Ninguna torre cumple los filtros seleccionados")
+else:
+    # Mostrar tabla
+    columnas_tabla = [
+        'ID_Torre', 'Nombre', 'Amenaza_SGC', 'Pendiente_Grados', 
+        'Lluvia_72h', 'Lluvia_24h', 'Clasificacion_Riesgo', 
+        'Emoji_Alerta', 'Nivel_Alerta'
+    ]
 
-# Mostrar tabla
-columnas_tabla = [
-    'ID_Torre', 'Nombre', 'Amenaza_SGC', 'Pendiente_Grados', 
-    'Lluvia_72h', 'Lluvia_24h', 'Clasificacion_Riesgo', 
-    'Emoji_Alerta', 'Nivel_Alerta'
-]
-
-st.dataframe(
-    torres_filtradas[columnas_tabla].style.applymap(
-        colorear_alerta,
-        subset=['Nivel_Alerta']
-    ).format({
-        'Pendiente_Grados': '{:.1f}°',
-        'Lluvia_72h': '{:.1f}mm',
-        'Lluvia_24h': '{:.1f}mm'
-    }),
-    use_container_width=True,
-    hide_index=True,
-    height=400
-)
+    st.dataframe(
+        torres_filtradas[columnas_tabla].style.apply(
+            colorear_alerta,
+            subset=['Nivel_Alerta']
+        ).format({
+            'Pendiente_Grados': '{:.1f}°',
+            'Lluvia_72h': '{:.1f}mm',
+            'Lluvia_24h': '{:.1f}mm'
+        }),
+        use_container_width=True,
+        hide_index=True,
+        height=400
+    )
 
-# Botón de descarga
-csv = torres_filtradas.to_csv(index=False).encode('utf-8')
-st.download_button(
-    label="📥 Descargar Datos como CSV",
-    data=csv,
-    file_name=f"torres_alertas_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
-    mime="text/csv"
-)
+    # Botón de descarga
+    # Columnas auxiliares de visualización (prefijo '_') no se exportan
+    columnas_export = [c for c in torres_filtradas.columns if not c.startswith('_')]
+    csv = convertir_csv(torres_filtradas[columnas_export])
+    st.download_button(
+        label="📥 Descargar Datos como CSV",
+        data=csv,
+        file_name=f"torres_alertas_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+        mime="text/csv"
+    )
 
 # ============================================================================
 # SECCIÓN 6: ANÁLISIS DE HISTORIAL (SI EXISTE)
@@ -732,7 +1024,7 @@ if not eventos_df.empty:
         st.plotly_chart(fig_magnitud, use_container_width=True)
     
     # Eventos en el tiempo
-    eventos_tiempo = eventos_df.set_index('Fecha').resample('M').size()
+    eventos_tiempo = eventos_df.groupby(pd.Grouper(key='Fecha', freq='MS')).size()
     
     fig_tiempo = go.Figure(data=[
         go.Scatter(
@@ -0,0 +1,58 @@
+"""
+Script para convertir los CSV de datos externos a formato parquet.
+El dashboard lee el parquet (columnar y tipado) en lugar de reparsear el CSV.
+"""
+
+import pandas as pd
+from pathlib import Path
+
+ARCHIVOS = [
+    "../data/03_external/ubicacion_torres_completo.csv",
+    "../data/03_external/umbrales_lluvia.csv",
+    "../data/03_external/historial_eventos.csv"
+]
+
+COLUMNAS_FECHA = {
+    "historial_eventos.csv": ['Fecha']
+}
+
+
+def convertir_a_parquet(ruta_csv):
+    """
+    Convierte un CSV a parquet en la misma carpeta y retorna la ruta generada.
+    """
+    ruta_csv = Path(ruta_csv)
+    df = pd.read_csv(ruta_csv, engine='pyarrow')
+    
+    for col in COLUMNAS_FECHA.get(ruta_csv.name, []):
+        df[col] = pd.to_datetime(df[col])
+    
+    ruta_parquet = ruta_csv.with_suffix('.parquet')
+    df.to_parquet(ruta_parquet, engine='pyarrow', index=False)
+    
+    return ruta_parquet
+
+
+def main():
+    """
+    Convierte todos los CSV usados por el dashboard.
+    """
+    print("=" * 70)
+    print("📦 CONVIRTIENDO CSV A PARQUET")
+    print("=" * 70)
+    
+    for ruta in ARCHIVOS:
+        if not Path(ruta).exists():
+            print(f"\n⚠️  No encontrado: {ruta}")
+            continue
+        
+        ruta_parquet = convertir_a_parquet(ruta)
+        print(f"\n✅ {ruta}")
+        print(f"   -> {ruta_parquet}")
+    
+    print("\n🚀 SIGUIENTE PASO: Ejecutar la aplicación de Streamlit")
+    print("   streamlit run app.py")
+
+
+if __name__ == "__main__":
+    main()
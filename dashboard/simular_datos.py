@@ -7,8 +7,8 @@ import pandas as pd
 import numpy as np
 from pathlib import Path
 
-# Configurar semilla para reproducibilidad
-np.random.seed(42)
+# Generador único con semilla para reproducibilidad (PCG64)
+rng = np.random.default_rng(42)
 
 def generar_datos_torres_extendido():
     """
@@ -41,7 +41,7 @@ def generar_datos_torres_extendido():
     categorias_amenaza = ['Muy Baja', 'Baja', 'Media', 'Alta', 'Muy Alta']
     probabilidades = [0.15, 0.25, 0.40, 0.15, 0.05]
     
-    df['Amenaza_SGC'] = np.random.choice(
+    df['Amenaza_SGC'] = rng.choice(
         categorias_amenaza, 
         size=len(df), 
         p=probabilidades
@@ -67,64 +67,59 @@ def generar_datos_torres_extendido():
         'Muy Alta': (40, 60)
     }
     
-    pendientes = []
-    for amenaza in df['Amenaza_SGC']:
-        min_p, max_p = pendiente_base[amenaza]
-        pendiente = np.random.uniform(min_p, max_p)
-        pendientes.append(round(pendiente, 2))
+    # Rangos por torre y una sola llamada vectorizada al generador
+    rangos = df['Amenaza_SGC'].map(pendiente_base)
+    minimos = np.array([r[0] for r in rangos])
+    maximos = np.array([r[1] for r in rangos])
     
-    df['Pendiente_Grados'] = pendientes
+    df['Pendiente_Grados'] = rng.uniform(minimos, maximos).round(2)
     
-    # Clasificar pendiente
-    def clasificar_pendiente(p):
-        if p < 15:
-            return 'Baja'
-        elif p < 30:
-            return 'Media'
-        else:
-            return 'Alta'
-    
-    df['Pendiente_Clase'] = df['Pendiente_Grados'].apply(clasificar_pendiente)
+    # Clasificar pendiente (< 15 Baja, < 30 Media, resto Alta)
+    df['Pendiente_Clase'] = pd.cut(
+        df['Pendiente_Grados'],
+        bins=[-np.inf, 15, 30, np.inf],
+        labels=['Baja', 'Media', 'Alta'],
+        right=False
+    )
     
     # SIMULAR ELEVACIÓN (metros sobre el nivel del mar)
-    df['Elevacion_msnm'] = np.random.randint(500, 2500, size=len(df))
+    df['Elevacion_msnm'] = rng.integers(500, 2500, size=len(df))
     
     # SIMULAR HISTORIAL DE EVENTOS (booleano)
     # 20% de torres han tenido eventos cercanos
-    df['Historial_Eventos'] = np.random.choice([True, False], size=len(df), p=[0.2, 0.8])
+    df['Historial_Eventos'] = rng.choice([True, False], size=len(df), p=[0.2, 0.8])
     
     # SIMULAR DISTANCIA A DRENAJES (metros)
     # Torres cerca de drenajes tienen mayor riesgo
-    df['Distancia_Drenaje_m'] = np.random.randint(10, 500, size=len(df))
+    df['Distancia_Drenaje_m'] = rng.integers(10, 500, size=len(df))
     
     # SIMULAR TIPO DE SUELO
     tipos_suelo = ['Arcilloso', 'Limoso', 'Arenoso', 'Rocoso', 'Mixto']
-    df['Tipo_Suelo'] = np.random.choice(tipos_suelo, size=len(df))
+    df['Tipo_Suelo'] = rng.choice(tipos_suelo, size=len(df))
     
     # SIMULAR COBERTURA VEGETAL
     coberturas = ['Bosque Denso', 'Bosque Disperso', 'Pastos', 'Cultivos', 'Suelo Desnudo']
-    df['Cobertura_Vegetal'] = np.random.choice(coberturas, size=len(df))
+    df['Cobertura_Vegetal'] = rng.choice(coberturas, size=len(df))
     
     # CALCULAR ÍNDICE DE RIESGO COMPUESTO (0-100)
-    # Combina múltiples factores
-    df['Indice_Riesgo'] = (
-        df['Amenaza_Valor'] * 15 +  # Peso: 15%
-        (df['Pendiente_Grados'] / 60 * 100) * 0.25 +  # Peso: 25%
-        df['Historial_Eventos'].astype(int) * 20 +  # Peso: 20%
-        (1 - df['Distancia_Drenaje_m'] / 500) * 15 +  # Peso: 15%
-        np.random.uniform(0, 25, size=len(df))  # Factor aleatorio: 25%
+    # Combina múltiples factores en una sola expresión (evaluada con numexpr si está instalado)
+    historial = df['Historial_Eventos'].astype(np.int8)
+    ruido = rng.uniform(0, 25, size=len(df))
+    df['Indice_Riesgo'] = df.eval(
+        'Amenaza_Valor * 15'  # Peso: 15%
+        ' + (Pendiente_Grados / 60 * 100) * 0.25'  # Peso: 25%
+        ' + @historial * 20'  # Peso: 20%
+        ' + (1 - Distancia_Drenaje_m / 500) * 15'  # Peso: 15%
+        ' + @ruido'  # Factor aleatorio: 25%
     ).round(2)
     
-    # Clasificar índice de riesgo
-    def clasificar_riesgo(idx):
-        if idx < 30:
-            return 'Bajo'
-        elif idx < 60:
-            return 'Medio'
-        else:
-            return 'Alto'
-    
-    df['Clasificacion_Riesgo'] = df['Indice_Riesgo'].apply(clasificar_riesgo)
+    # Clasificar índice de riesgo (< 30 Bajo, < 60 Medio, resto Alto)
+    df['Clasificacion_Riesgo'] = pd.cut(
+        df['Indice_Riesgo'],
+        bins=[-np.inf, 30, 60, np.inf],
+        labels=['Bajo', 'Medio', 'Alto'],
+        right=False
+    )
     
     return df
 
@@ -147,13 +142,13 @@ def generar_historial_eventos():
             start='2020-01-01', 
             end='2024-12-31', 
             periods=n_eventos
-        ).date,
-        'ID_Torre': np.random.choice(torres_con_eventos, size=n_eventos),
-        'Magnitud': np.random.choice(['Menor', 'Moderado', 'Severo'], size=n_eventos, p=[0.5, 0.3, 0.2]),
-        'Precipitacion_72h_mm': np.random.uniform(50, 250, size=n_eventos).round(1),
-        'Afecto_Infraestructura': np.random.choice([True, False], size=n_eventos, p=[0.3, 0.7]),
-        'Tiempo_Respuesta_horas': np.random.randint(1, 48, size=n_eventos),
-        'Costo_Reparacion_USD': np.random.randint(0, 50000, size=n_eventos)
+        ).to_numpy().astype('datetime64[D]'),
+        'ID_Torre': rng.choice(torres_con_eventos, size=n_eventos),
+        'Magnitud': rng.choice(['Menor', 'Moderado', 'Severo'], size=n_eventos, p=[0.5, 0.3, 0.2]),
+        'Precipitacion_72h_mm': rng.uniform(50, 250, size=n_eventos).round(1),
+        'Afecto_Infraestructura': rng.choice([True, False], size=n_eventos, p=[0.3, 0.7]),
+        'Tiempo_Respuesta_horas': rng.integers(1, 48, size=n_eventos),
+        'Costo_Reparacion_USD': rng.integers(0, 50000, size=n_eventos)
     }
     
     df_eventos = pd.DataFrame(eventos_data)
@@ -189,6 +184,15 @@ def generar_umbrales_lluvia():
     return df_umbrales
 
 
+def guardar_tabla(df, ruta_csv):
+    """
+    Guarda la tabla en parquet (lectura rápida y tipada en el dashboard) y en CSV por compatibilidad.
+    """
+    df.to_csv(ruta_csv, index=False)
+    # El parquet se escribe después para que el dashboard lo considere al día
+    df.to_parquet(Path(ruta_csv).with_suffix('.parquet'), engine='pyarrow', index=False)
+
+
 def main():
     """
     Ejecuta la generación completa de datos simulados.
@@ -200,7 +204,7 @@ def main():
     # 1. Generar datos de torres
     df_torres = generar_datos_torres_extendido()
     ruta_torres = "../data/03_external/ubicacion_torres_completo.csv"
-    df_torres.to_csv(ruta_torres, index=False)
+    guardar_tabla(df_torres, ruta_torres)
     
     print(f"\n✅ Datos de torres guardados en:")
     print(f"   {ruta_torres}")
@@ -210,7 +214,7 @@ def main():
     # 2. Generar historial de eventos
     df_eventos = generar_historial_eventos()
     ruta_eventos = "../data/03_external/historial_eventos.csv"
-    df_eventos.to_csv(ruta_eventos, index=False)
+    guardar_tabla(df_eventos, ruta_eventos)
     
     print(f"\n✅ Historial de eventos guardado en:")
     print(f"   {ruta_eventos}")
@@ -219,7 +223,7 @@ def main():
     # 3. Generar umbrales de lluvia
     df_umbrales = generar_umbrales_lluvia()
     ruta_umbrales = "../data/03_external/umbrales_lluvia.csv"
-    df_umbrales.to_csv(ruta_umbrales, index=False)
+    guardar_tabla(df_umbrales, ruta_umbrales)
     
     print(f"\n✅ Umbrales de lluvia guardados en:")
     print(f"   {ruta_umbrales}")